@@ -5,13 +5,40 @@ Create venice_airbnb_buildings.geojson by matching listings to buildings using D
 - Aggregate: host_since (earliest), price (sum), accommodates (sum), availability_365 (sum), beds (sum), bathrooms_text (sum)
 """
 
-import json
 import duckdb
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
 import os
-from shapely.geometry import Point
-from shapely.ops import nearest_points
+
+BUILDINGS_PATH = 'frontend/public/output/venice_buildings.geojson'
+BUILDINGS_CACHE_PATH = 'cache/venice_buildings.parquet'
+
+# Listing columns used for matching and aggregation
+LISTING_COLUMNS = [
+    'id', 'latitude', 'longitude', 'host_since', 'price',
+    'accommodates', 'availability_365', 'beds', 'bathrooms_text'
+]
+
+def load_buildings(path=BUILDINGS_PATH, cache_path=BUILDINGS_CACHE_PATH):
+    """Load buildings in EPSG:4326 plus a UTM 33N geometry column.
+    
+    The parsed and projected layer is cached as GeoParquet and reused until
+    the source GeoJSON changes.
+    """
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        print(f"Using cached buildings from {cache_path}")
+        return gpd.read_parquet(cache_path)
+    
+    buildings_gdf = gpd.read_file(path, engine='pyogrio', use_arrow=True).to_crs('EPSG:4326')
+    buildings_gdf['geometry_utm'] = buildings_gdf.geometry.to_crs('EPSG:32633')
+    
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    buildings_gdf.to_parquet(cache_path)
+    return buildings_gdf
 
 def main():
     print("=" * 60)
@@ -23,124 +50,127 @@ def main():
     
     # Step 1: Load buildings GeoJSON
     print("\n[1/4] Loading buildings GeoJSON...")
-    buildings_gdf = gpd.read_file('frontend/public/output/venice_buildings.geojson')
-    print(f"Loaded {len(buildings_gdf)} buildings")
+    buildings_4326 = load_buildings()
+    print(f"Loaded {len(buildings_4326)} buildings")
     
     # Step 2: Load listings CSV
     print("\n[2/4] Loading listings CSV...")
-    listings_df = pd.read_csv('Venezia/listings_red01.csv')
+    listings_table = pa_csv.read_csv(
+        'Venezia/listings_red01.csv',
+        # Raw exports carry quoted multi-line text fields (description, neighborhood_overview)
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=LISTING_COLUMNS,
+            column_types={'host_since': pa.string()},  # Keep ISO dates as text, as in the output
+            strings_can_be_null=True
+        )
+    )
+    
+    # Raw exports store price as text ("$1,234.00"); parse it in Arrow
+    if pa.types.is_string(listings_table.schema.field('price').type):
+        price = pc.replace_substring_regex(listings_table['price'], pattern=r'[$,]', replacement='')
+        listings_table = listings_table.set_column(
+            listings_table.schema.get_field_index('price'), 'price', pc.cast(price, pa.float64())
+        )
+    
+    listings_df = listings_table.to_pandas(types_mapper=pd.ArrowDtype)
     print(f"Loaded {len(listings_df)} listings")
     
     # Filter out listings without coordinates
     listings_clean = listings_df.dropna(subset=['latitude', 'longitude']).copy()
     print(f"Valid listings with coordinates: {len(listings_clean)}")
     
+    # bathrooms_text is free text in the full Inside Airbnb export ("1.5 baths",
+    # "Half-bath"); keep its numeric value so it can be summed per building
+    if not pd.api.types.is_numeric_dtype(listings_clean['bathrooms_text']):
+        bathrooms = listings_clean['bathrooms_text'].astype('string')
+        bathroom_count = bathrooms.str.extract(r'(\d+(?:\.\d+)?)', expand=False).astype(float)
+        is_half_bath = bathrooms.str.contains('half', case=False, na=False)
+        listings_clean['bathrooms_text'] = bathroom_count.mask(bathroom_count.isna() & is_half_bath, 0.5)
+    
     # Create Point geometries for listings
-    listings_clean['geometry'] = listings_clean.apply(
-        lambda row: Point(row['longitude'], row['latitude']), axis=1
+    listings_gdf = gpd.GeoDataFrame(
+        listings_clean,
+        geometry=gpd.points_from_xy(listings_clean['longitude'], listings_clean['latitude']),
+        crs='EPSG:4326'
     )
-    listings_gdf = gpd.GeoDataFrame(listings_clean, crs='EPSG:4326')
     
     # Step 3: Spatial join - find listings within buildings
     print("\n[3/4] Matching listings to buildings...")
     
-    # Convert to same CRS for spatial operations
-    buildings_4326 = buildings_gdf.to_crs('EPSG:4326')
+    # Match in a metric CRS (UTM 33N) so nearest distances are in meters;
+    # the within join and the nearest lookup share this layer's STRtree index
+    buildings_utm = buildings_4326[['geometry_utm']].set_geometry('geometry_utm')
+    listings_utm = listings_gdf.to_crs('EPSG:32633')
     
     # Perform spatial join
-    joined = gpd.sjoin(listings_gdf, buildings_4326, how='left', predicate='within')
+    joined = gpd.sjoin(listings_utm, buildings_utm, how='left', predicate='within')
     
-    # Separate matched and unmatched listings
-    matched = joined[joined.index_right.notna()].copy()
-    unmatched = joined[joined.index_right.isna()].copy()
+    # Listings that fell outside every building
+    unmatched_mask = joined['index_right'].isna().to_numpy()
     
-    print(f"Listings matched to buildings: {len(matched)}")
-    print(f"Listings not matched (will assign to closest): {len(unmatched)}")
+    print(f"Listings matched to buildings: {int((~unmatched_mask).sum())}")
+    print(f"Listings not matched (will assign to closest): {int(unmatched_mask.sum())}")
     
     # Step 4: Assign unmatched listings to closest buildings
-    if len(unmatched) > 0:
+    if unmatched_mask.any():
         print("Assigning unmatched listings to closest buildings...")
         
-        unmatched_indices = []
-        closest_building_indices = []
+        # One bulk nearest query against the buildings' STRtree (polygon-exact);
+        # return_all=False keeps a single building on distance ties
+        listing_pos, building_pos = buildings_utm.sindex.nearest(joined.geometry[unmatched_mask], return_all=False)
         
-        for idx, listing in unmatched.iterrows():
-            listing_point = listing.geometry
-            min_distance = float('inf')
-            closest_building_idx = None
-            
-            # Find closest building
-            for building_idx, building in buildings_4326.iterrows():
-                distance = listing_point.distance(building.geometry)
-                if distance < min_distance:
-                    min_distance = distance
-                    closest_building_idx = building_idx
-            
-            if closest_building_idx is not None:
-                unmatched_indices.append(idx)
-                closest_building_indices.append(closest_building_idx)
+        # Fill in the closest building index in place on the joined frame
+        unmatched_rows = np.flatnonzero(unmatched_mask)[listing_pos]
+        joined.iloc[unmatched_rows, joined.columns.get_loc('index_right')] = buildings_utm.index[building_pos]
         
-        # Update unmatched listings with closest building index
-        for i, listing_idx in enumerate(unmatched_indices):
-            building_idx = closest_building_indices[i]
-            unmatched.loc[listing_idx, 'index_right'] = building_idx
-        
-        print(f"Assigned {len(unmatched_indices)} unmatched listings to closest buildings")
-        
-        # Combine matched and now-assigned unmatched
-        all_matched = pd.concat([matched, unmatched])
-    else:
-        all_matched = matched
+        print(f"Assigned {len(unmatched_rows)} unmatched listings to closest buildings")
     
     # Step 5: Aggregate data by building
     print("\n[4/4] Aggregating data by building...")
     
-    # Group by building index and aggregate
-    aggregated = all_matched.groupby('index_right').agg({
-        'host_since': 'min',  # Earliest host_since
-        'price': 'sum',  # Sum of prices
-        'accommodates': 'sum',  # Sum of accommodates
-        'availability_365': 'sum',  # Sum of availability_365
-        'beds': 'sum',  # Sum of beds
-        'bathrooms_text': 'sum'  # Sum of bathrooms_text
-    }).reset_index()
-    
-    aggregated.columns = ['building_index', 'host_since', 'price', 'accommodates', 
-                          'availability_365', 'beds', 'bathrooms_text']
-    
-    # Count listings per building
-    listing_counts = all_matched.groupby('index_right').size().reset_index(name='listing_count')
-    listing_counts.columns = ['building_index', 'listing_count']
+    # Group by building index and aggregate in a single DuckDB pass
+    sum_columns = ['price', 'accommodates', 'availability_365', 'beds', 'bathrooms_text']
+    conn.register('matched_listings', joined[['index_right', 'host_since'] + sum_columns])
+    
+    aggregation_query = """
+    SELECT 
+        CAST(index_right AS BIGINT) AS building_index,
+        MIN(host_since) AS host_since,  -- Earliest host_since
+        COALESCE(SUM(price), 0) AS price,  -- Sum of prices
+        COALESCE(SUM(accommodates), 0) AS accommodates,  -- Sum of accommodates
+        COALESCE(SUM(availability_365), 0) AS availability_365,  -- Sum of availability_365
+        COALESCE(SUM(beds), 0) AS beds,  -- Sum of beds
+        COALESCE(SUM(bathrooms_text), 0) AS bathrooms_text,  -- Sum of bathrooms_text
+        COUNT(*) AS listing_count  -- Listings per building
+    FROM matched_listings
+    GROUP BY index_right
+    """
+    
+    aggregated = conn.execute(aggregation_query).df()
+    conn.close()
+    
+    # DuckDB widens integer sums to HUGEINT (returned as float); restore the input dtypes
+    aggregated = aggregated.astype({col: joined[col].dtype for col in sum_columns})
     
     # Merge aggregated data with buildings
-    buildings_with_data = buildings_4326.copy()
+    buildings_with_data = buildings_4326.drop(columns='geometry_utm')
     buildings_with_data['building_index'] = buildings_with_data.index
     
     # Merge aggregated data
     buildings_with_data = buildings_with_data.merge(aggregated, on='building_index', how='inner')
-    buildings_with_data = buildings_with_data.merge(listing_counts, on='building_index', how='left')
-    
-    # Fill NaN values for listing_count (buildings with no listings)
-    buildings_with_data['listing_count'] = buildings_with_data['listing_count'].fillna(0).astype(int)
     
     print(f"Buildings with listings: {len(buildings_with_data)}")
-    print(f"Total listings assigned: {all_matched.groupby('index_right').size().sum()}")
+    print(f"Total listings assigned: {int(aggregated['listing_count'].sum())}")
     
     # Step 6: Convert to GeoJSON and save
     print("\n[5/5] Saving to GeoJSON...")
     
-    # Convert to GeoJSON
-    buildings_geojson = json.loads(buildings_with_data.to_json())
-    
-    # Clean and save
+    # Save via GDAL's GeoJSON driver, skipping the to_json/json.loads/json.dumps round-trip
     output_path = 'frontend/public/output/venice_airbnb_buildings.geojson'
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     
-    json_str = json.dumps(buildings_geojson, ensure_ascii=False, indent=2)
-    json_str_clean = json_str.replace('\x00', '')  # Remove null bytes
-    
-    with open(output_path, 'w', encoding='utf-8', newline='\n') as f:
-        f.write(json_str_clean)
+    buildings_with_data.to_file(output_path, driver='GeoJSON', engine='pyogrio', use_arrow=True)
     
     print(f"Saved to {output_path}")
     
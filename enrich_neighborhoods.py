@@ -6,7 +6,6 @@ Calculates aggregations for listings within each neighborhood polygon.
 import geopandas as gpd
 import pandas as pd
 import numpy as np
-import json
 import os
 from shapely.geometry import Point
 
@@ -23,12 +22,18 @@ def enrich_neighborhoods():
     
     # Step 1: Load neighborhoods GeoJSON
     print("\n[1/4] Loading neighborhoods GeoJSON...")
-    neighborhoods_gdf = gpd.read_file(neighborhoods_path)
+    neighborhoods_gdf = gpd.read_file(neighborhoods_path, engine='pyogrio', use_arrow=True)
     print(f"Loaded {len(neighborhoods_gdf)} neighborhoods")
     
     # Step 2: Load buildings GeoJSON
     print("\n[2/4] Loading buildings GeoJSON...")
-    buildings_gdf = gpd.read_file(buildings_path)
+    # Only the aggregated columns are needed; GDAL skips reading the rest
+    buildings_gdf = gpd.read_file(
+        buildings_path,
+        engine='pyogrio',
+        use_arrow=True,
+        columns=['listing_count', 'accommodates', 'availability_365', 'price']
+    )
     print(f"Loaded {len(buildings_gdf)} buildings")
     
     # Ensure both are in the same CRS
@@ -36,79 +41,71 @@ def enrich_neighborhoods():
         print(f"Converting CRS: neighborhoods {neighborhoods_gdf.crs} -> buildings {buildings_gdf.crs}")
         neighborhoods_gdf = neighborhoods_gdf.to_crs(buildings_gdf.crs)
     
-    # Step 3: Perform spatial join to find buildings within each neighborhood
-    print("\n[3/4] Performing spatial join (buildings within neighborhoods)...")
-    
-    # Create a spatial index for buildings for faster joins
-    buildings_sindex = buildings_gdf.sindex
-    
-    # Initialize result columns
-    neighborhoods_gdf['listings_total'] = 0
-    neighborhoods_gdf['total_guests_per_night'] = 0.0
-    neighborhoods_gdf['guest_night_capacity_per_year'] = 0.0
-    neighborhoods_gdf['total_price_per_night'] = 0.0
-    neighborhoods_gdf['median_price_per_unit'] = None
-    neighborhoods_gdf['max_price_per_unit'] = None
-    neighborhoods_gdf['min_price_per_unit'] = None
-    
-    # Process each neighborhood
-    for idx, neighborhood in neighborhoods_gdf.iterrows():
-        # Find buildings that might intersect with this neighborhood using spatial index
-        possible_matches_index = list(buildings_sindex.intersection(neighborhood.geometry.bounds))
-        possible_matches = buildings_gdf.iloc[possible_matches_index]
-        
-        # Filter to only buildings that are actually within this neighborhood
-        # Using 'within' to ensure buildings are completely inside the neighborhood polygon
-        buildings_in_neighborhood = possible_matches[possible_matches.geometry.within(neighborhood.geometry)]
-        
-        if len(buildings_in_neighborhood) > 0:
-            # Get relevant columns
-            listing_counts = buildings_in_neighborhood['listing_count'].fillna(0)
-            accommodates = buildings_in_neighborhood['accommodates'].fillna(0)
-            availability = buildings_in_neighborhood['availability_365'].fillna(0)
-            prices = buildings_in_neighborhood['price'].fillna(0)
-            
-            # Calculate aggregations
-            # listings total: sum of listing_count
-            neighborhoods_gdf.at[idx, 'listings_total'] = int(listing_counts.sum())
-            
-            # total guests per night: sum of accommodates * listing_count
-            total_guests = (accommodates * listing_counts).sum()
-            neighborhoods_gdf.at[idx, 'total_guests_per_night'] = float(total_guests)
-            
-            # guest-night capacity per year: sum of accommodates * availability_365 * listing_count
-            guest_night_capacity = (accommodates * availability * listing_counts).sum()
-            neighborhoods_gdf.at[idx, 'guest_night_capacity_per_year'] = float(guest_night_capacity)
-            
-            # total price per night: sum of price (price is already total for building)
-            neighborhoods_gdf.at[idx, 'total_price_per_night'] = float(prices.sum())
-            
-            # Price statistics per unit (price per listing)
-            # Calculate price per unit for each building: price / listing_count
-            # Only consider buildings with valid prices > 0 and listing_count > 0
-            valid_mask = (prices > 0) & (listing_counts > 0)
-            if valid_mask.sum() > 0:
-                prices_per_unit = prices[valid_mask] / listing_counts[valid_mask]
-                neighborhoods_gdf.at[idx, 'median_price_per_unit'] = float(prices_per_unit.median())
-                neighborhoods_gdf.at[idx, 'max_price_per_unit'] = float(prices_per_unit.max())
-                neighborhoods_gdf.at[idx, 'min_price_per_unit'] = float(prices_per_unit.min())
-        
-        # Progress indicator
-        if (idx + 1) % 10 == 0:
-            print(f"  Processed {idx + 1}/{len(neighborhoods_gdf)} neighborhoods...")
+    # Step 3: Perform spatial join to find the neighborhood of each building
+    print("\n[3/4] Performing spatial join (building centroids in neighborhoods)...")
+    
+    # Assign each building by its centroid (computed in UTM 33N), so buildings
+    # straddling a boundary count once instead of being dropped by 'within';
+    # point-in-polygon 'intersects' is the cheap GEOS path for the single join
+    building_centroids = buildings_gdf.geometry.to_crs('EPSG:32633').centroid.to_crs(buildings_gdf.crs)
+    joined = gpd.sjoin(
+        buildings_gdf.set_geometry(building_centroids),
+        neighborhoods_gdf[['geometry']],
+        how='inner',
+        predicate='intersects'
+    )
+    
+    # Get relevant columns
+    listing_counts = joined['listing_count'].fillna(0)
+    accommodates = joined['accommodates'].fillna(0)
+    availability = joined['availability_365'].fillna(0)
+    prices = joined['price'].fillna(0)
+    
+    # Per-building terms, summed per neighborhood below
+    per_building = pd.DataFrame({
+        'index_right': joined['index_right'],
+        # listings total: sum of listing_count
+        'listings_total': listing_counts,
+        # total guests per night: sum of accommodates * listing_count
+        'total_guests_per_night': accommodates * listing_counts,
+        # guest-night capacity per year: sum of accommodates * availability_365 * listing_count
+        'guest_night_capacity_per_year': accommodates * availability * listing_counts,
+        # total price per night: sum of price (price is already total for building)
+        'total_price_per_night': prices,
+        # Price per unit (price per listing): price / listing_count
+        # Only consider buildings with valid prices > 0 and listing_count > 0
+        'price_per_unit': (prices / listing_counts).where((prices > 0) & (listing_counts > 0)),
+    })
+    
+    # Calculate aggregations
+    stats = per_building.groupby('index_right').agg(
+        listings_total=('listings_total', 'sum'),
+        total_guests_per_night=('total_guests_per_night', 'sum'),
+        guest_night_capacity_per_year=('guest_night_capacity_per_year', 'sum'),
+        total_price_per_night=('total_price_per_night', 'sum'),
+        median_price_per_unit=('price_per_unit', 'median'),
+        max_price_per_unit=('price_per_unit', 'max'),
+        min_price_per_unit=('price_per_unit', 'min'),
+    )
+    
+    # Align the aggregates to all neighborhoods; neighborhoods without buildings
+    # get zero totals while the price-per-unit stats stay empty
+    stats = stats.reindex(neighborhoods_gdf.index)
+    total_cols = ['listings_total', 'total_guests_per_night', 'guest_night_capacity_per_year', 'total_price_per_night']
+    stats[total_cols] = stats[total_cols].fillna(0.0).astype(float)
+    stats['listings_total'] = stats['listings_total'].astype(int)
+    
+    # Write all result columns in one block assignment (overwriting any from a previous run)
+    neighborhoods_gdf[list(stats.columns)] = stats
     
     print(f"Completed processing all {len(neighborhoods_gdf)} neighborhoods")
     
     # Step 4: Save enriched neighborhoods GeoJSON
     print("\n[4/4] Saving enriched neighborhoods GeoJSON...")
     
-    # Convert to GeoJSON dict
-    neighborhoods_geojson = json.loads(neighborhoods_gdf.to_json())
-    
-    # Save with proper formatting
+    # Write through GDAL's GeoJSON driver (no intermediate Python dicts or JSON strings)
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(neighborhoods_geojson, f, ensure_ascii=False, indent=2)
+    neighborhoods_gdf.to_file(output_path, driver='GeoJSON', engine='pyogrio', use_arrow=True)
     
     print(f"Saved enriched neighborhoods to {output_path}")
     
@@ -1,20 +1,55 @@
 """
-Fetch Venice building data from OpenStreetMap and classify by type using DuckDB
+Fetch Venice building data from OpenStreetMap and classify by type
 """
 
-import json
+import itertools
+import ijson
 import requests
-import duckdb
 import geopandas as gpd
-from shapely.geometry import shape
+import numpy as np
+import pandas as pd
+import shapely
 import os
 
 # Venice municipality relation ID and ISTAT code
 VENICE_RELATION_ID = 44741
 VENICE_ISTAT_CODE = "027042"  # More reliable identifier
 
+# OSM tag value -> building class lookups used by classify_buildings
+TOURISM_CLASSES = {
+    'hotel': 'hotel', 'hostel': 'hotel', 'apartment': 'hotel',
+}
+AMENITY_CLASSES = {
+    'restaurant': 'restaurant', 'cafe': 'restaurant', 'bar': 'restaurant', 'fast_food': 'restaurant',
+    'school': 'education', 'university': 'education', 'college': 'education',
+    'hospital': 'healthcare', 'clinic': 'healthcare', 'pharmacy': 'healthcare',
+    'place_of_worship': 'religious', 'church': 'religious',
+}
+BUILDING_CLASSES = {
+    'residential': 'residential', 'house': 'residential', 'apartments': 'residential',
+    'commercial': 'commercial', 'retail': 'commercial',
+    'industrial': 'industrial', 'warehouse': 'industrial',
+    'hotel': 'hotel',
+    'school': 'education', 'university': 'education',
+    'hospital': 'healthcare', 'clinic': 'healthcare',
+    'church': 'religious', 'cathedral': 'religious', 'mosque': 'religious', 'synagogue': 'religious',
+    'public': 'public', 'civic': 'public',
+    'garage': 'parking', 'parking': 'parking',
+    'yes': 'unknown',
+}
+
+def stream_osm_elements(overpass_url, query):
+    """Stream Overpass API elements one at a time without buffering the full response."""
+    with requests.post(overpass_url, data=query, stream=True, timeout=600) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        yield from ijson.items(response.raw, 'elements.item', use_float=True)
+
 def fetch_osm_buildings():
-    """Fetch building data from OpenStreetMap Overpass API for Venice municipality."""
+    """Fetch building data from OpenStreetMap Overpass API for Venice municipality.
+    
+    Returns an iterator over the OSM elements, parsed as they are downloaded.
+    """
     print("Fetching building data from OpenStreetMap...")
     print(f"Using Venice municipality boundary (relation {VENICE_RELATION_ID}, ISTAT: {VENICE_ISTAT_CODE})")
     
@@ -47,13 +82,11 @@ def fetch_osm_buildings():
     # Try ISTAT code first
     try:
         print("Attempting to fetch using ISTAT code...")
-        response = requests.post(overpass_url, data=query_istat, timeout=600)
-        response.raise_for_status()
-        data = response.json()
-        elements = data.get('elements', [])
-        if len(elements) > 0:
-            print(f"Successfully fetched {len(elements)} building elements using ISTAT code")
-            return data
+        elements = stream_osm_elements(overpass_url, query_istat)
+        first_element = next(elements, None)
+        if first_element is not None:
+            print("Streaming building elements fetched using ISTAT code")
+            return itertools.chain([first_element], elements)
         else:
             print("No elements found with ISTAT code, trying relation ID...")
             raise ValueError("No elements found")
@@ -61,144 +94,105 @@ def fetch_osm_buildings():
         print(f"ISTAT code method failed: {e}")
         print("Trying relation ID method...")
         try:
-            response = requests.post(overpass_url, data=query_relation, timeout=600)
-            response.raise_for_status()
-            data = response.json()
-            elements = data.get('elements', [])
-            print(f"Successfully fetched {len(elements)} building elements using relation ID")
-            return data
+            elements = stream_osm_elements(overpass_url, query_relation)
+            first_element = next(elements, None)
+            print("Streaming building elements fetched using relation ID")
+            return itertools.chain([first_element] if first_element is not None else [], elements)
         except Exception as e2:
             print(f"Error fetching OSM data with relation ID: {e2}")
             return None
 
-def convert_osm_to_geojson(osm_data):
-    """Convert OSM data to GeoJSON format."""
-    if not osm_data or 'elements' not in osm_data:
+def convert_osm_to_geodataframe(osm_elements):
+    """Convert OSM elements to a GeoDataFrame of building polygons in a single streaming pass."""
+    if osm_elements is None:
         return None
     
-    features = []
-    nodes = {}
-    
-    # First pass: collect all nodes
-    for element in osm_data['elements']:
-        if element['type'] == 'node':
-            nodes[element['id']] = (element['lon'], element['lat'])
-    
-    # Second pass: convert ways and relations to features
-    for element in osm_data['elements']:
+    # Coordinates are collected as flat arrays (one entry per vertex) plus a
+    # vertex count per way, so all polygons can be built in one vectorized call
+    lons = []
+    lats = []
+    vertex_counts = []
+    properties = []
+    element_count = 0
+    
+    # Collect ways as the elements arrive
+    for element in osm_elements:
+        element_count += 1
         if element['type'] == 'way' and 'geometry' in element:
-            # Extract tags
-            tags = element.get('tags', {})
-            building_type = tags.get('building', 'unknown')
+            geometry = element['geometry']
+            n_vertices = len(geometry)
             
-            # Get coordinates from geometry
-            coords = []
-            for node in element['geometry']:
-                coords.append([node['lon'], node['lat']])
+            # Valid polygon needs at least 4 points including the closing one;
+            # open rings are closed by shapely.linearrings below
+            is_closed = n_vertices > 0 and geometry[0] == geometry[-1]
+            if n_vertices < (4 if is_closed else 3):
+                continue
             
-            # Close polygon if not already closed
-            if len(coords) > 2 and coords[0] != coords[-1]:
-                coords.append(coords[0])
+            # Get coordinates from geometry
+            for node in geometry:
+                lons.append(node['lon'])
+                lats.append(node['lat'])
+            vertex_counts.append(n_vertices)
             
-            if len(coords) >= 4:  # Valid polygon needs at least 4 points (including closing)
-                feature = {
-                    'type': 'Feature',
-                    'geometry': {
-                        'type': 'Polygon',
-                        'coordinates': [coords]
-                    },
-                    'properties': {
-                        'id': f"way_{element['id']}",
-                        'building': building_type,
-                        'name': tags.get('name', ''),
-                        'amenity': tags.get('amenity', ''),
-                        'tourism': tags.get('tourism', ''),
-                        'shop': tags.get('shop', ''),
-                        'office': tags.get('office', ''),
-                        'leisure': tags.get('leisure', ''),
-                        'building_levels': tags.get('building:levels', ''),
-                        'addr_street': tags.get('addr:street', ''),
-                        'addr_housenumber': tags.get('addr:housenumber', '')
-                    }
-                }
-                features.append(feature)
-    
-    geojson = {
-        'type': 'FeatureCollection',
-        'features': features
-    }
-    
-    print(f"Converted {len(features)} buildings to GeoJSON")
-    return geojson
+            # Extract tags
+            tags = element.get('tags', {})
+            properties.append({
+                'id': f"way_{element['id']}",
+                'building': tags.get('building', 'unknown'),
+                'name': tags.get('name', ''),
+                'amenity': tags.get('amenity', ''),
+                'tourism': tags.get('tourism', ''),
+                'shop': tags.get('shop', ''),
+                'office': tags.get('office', ''),
+                'leisure': tags.get('leisure', ''),
+                'building_levels': tags.get('building:levels', ''),
+                'addr_street': tags.get('addr:street', ''),
+                'addr_housenumber': tags.get('addr:housenumber', '')
+            })
+    
+    coords = np.column_stack([np.asarray(lons, dtype=float), np.asarray(lats, dtype=float)])
+    ring_indices = np.repeat(np.arange(len(vertex_counts)), vertex_counts)
+    polygons = shapely.polygons(shapely.linearrings(coords, indices=ring_indices))
+    
+    gdf = gpd.GeoDataFrame(pd.DataFrame(properties), geometry=polygons, crs='EPSG:4326')
+    
+    print(f"Converted {len(gdf)} buildings from {element_count} OSM elements")
+    return gdf
 
-def classify_buildings_with_duckdb(geojson_data):
-    """Classify buildings by type using DuckDB."""
-    print("Classifying buildings with DuckDB...")
-    
-    # Convert GeoJSON to GeoDataFrame
-    gdf = gpd.GeoDataFrame.from_features(geojson_data['features'])
-    
-    # Create DuckDB connection
-    conn = duckdb.connect()
-    
-    # Convert GeoDataFrame to pandas DataFrame (without geometry) for DuckDB
-    df = gdf.drop(columns=['geometry']).copy()
-    
-    # Register DataFrame with DuckDB
-    conn.register('buildings', df)
+def classify_buildings(gdf):
+    """Classify buildings by type from their OSM tags."""
+    print("Classifying buildings...")
     
     # Classify buildings based on OSM tags
-    # Priority: tourism=hotel > amenity > building tag > other tags
-    classification_query = """
-    SELECT 
-        *,
-        CASE 
-            WHEN tourism = 'hotel' OR tourism = 'hostel' OR tourism = 'apartment' THEN 'hotel'
-            WHEN amenity = 'restaurant' OR amenity = 'cafe' OR amenity = 'bar' OR amenity = 'fast_food' THEN 'restaurant'
-            WHEN amenity = 'school' OR amenity = 'university' OR amenity = 'college' THEN 'education'
-            WHEN amenity = 'hospital' OR amenity = 'clinic' OR amenity = 'pharmacy' THEN 'healthcare'
-            WHEN amenity = 'place_of_worship' OR amenity = 'church' THEN 'religious'
-            WHEN shop IS NOT NULL AND shop != '' THEN 'commercial'
-            WHEN office IS NOT NULL AND office != '' THEN 'office'
-            WHEN leisure IS NOT NULL AND leisure != '' THEN 'leisure'
-            WHEN building = 'residential' OR building = 'house' OR building = 'apartments' THEN 'residential'
-            WHEN building = 'commercial' OR building = 'retail' THEN 'commercial'
-            WHEN building = 'industrial' OR building = 'warehouse' THEN 'industrial'
-            WHEN building = 'hotel' THEN 'hotel'
-            WHEN building = 'school' OR building = 'university' THEN 'education'
-            WHEN building = 'hospital' OR building = 'clinic' THEN 'healthcare'
-            WHEN building = 'church' OR building = 'cathedral' OR building = 'mosque' OR building = 'synagogue' THEN 'religious'
-            WHEN building = 'public' OR building = 'civic' THEN 'public'
-            WHEN building = 'garage' OR building = 'parking' THEN 'parking'
-            WHEN building = 'yes' THEN 'unknown'
-            ELSE COALESCE(building, 'unknown')
-        END as building_type_classified
-    FROM buildings
-    """
+    # Priority: tourism=hotel > amenity > shop/office/leisure > building tag;
+    # each rule only fills buildings left unclassified by the rules before it
+    has_shop = gdf['shop'].notna() & (gdf['shop'] != '')
+    has_office = gdf['office'].notna() & (gdf['office'] != '')
+    has_leisure = gdf['leisure'].notna() & (gdf['leisure'] != '')
+    
+    rules = [
+        gdf['tourism'].map(TOURISM_CLASSES),
+        gdf['amenity'].map(AMENITY_CLASSES),
+        pd.Series('commercial', index=gdf.index).where(has_shop),
+        pd.Series('office', index=gdf.index).where(has_office),
+        pd.Series('leisure', index=gdf.index).where(has_leisure),
+        gdf['building'].map(BUILDING_CLASSES),
+        gdf['building'].fillna('unknown'),
+    ]
+    
+    building_type_classified = rules[0]
+    for rule in rules[1:]:
+        building_type_classified = building_type_classified.fillna(rule)
     
-    classified_df = conn.execute(classification_query).df()
+    classified_gdf = gdf.copy()
+    classified_gdf['building_type_classified'] = building_type_classified.astype('category')
     
     # Get statistics
-    stats_query = """
-    SELECT 
-        building_type_classified,
-        COUNT(*) as count
-    FROM (""" + classification_query + """) classified
-    GROUP BY building_type_classified
-    ORDER BY count DESC
-    """
-    
-    stats = conn.execute(stats_query).df()
+    stats = classified_gdf['building_type_classified'].value_counts().reset_index()
     
     print("\nBuilding classification statistics:")
     print(stats.to_string(index=False))
     
-    conn.close()
-    
-    # Merge classification back with geometry
-    classified_gdf = gdf.copy()
-    classified_gdf['building_type_classified'] = classified_df['building_type_classified'].values
-    
     return classified_gdf
 
 def save_geojson(gdf, output_path):
@@ -206,14 +200,9 @@ def save_geojson(gdf, output_path):
     # Ensure output directory exists
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     
-    # Convert to GeoJSON dict and save with json.dump for browser compatibility
-    import re
-    geojson_dict = json.loads(gdf.to_json())
-    # Clean the JSON string to remove any control characters
-    json_str = json.dumps(geojson_dict, ensure_ascii=False, indent=2)
-    json_str_clean = re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F]', '', json_str)
-    with open(output_path, 'w', encoding='utf-8', newline='\n') as f:
-        f.write(json_str_clean)
+    # GDAL's GeoJSON writer escapes control characters, so the output stays
+    # valid JSON for the browser without a regex cleanup pass
+    gdf.to_file(output_path, driver='GeoJSON', engine='pyogrio', use_arrow=True)
     print(f"\nSaved classified buildings to {output_path}")
     print(f"Total buildings: {len(gdf)}")
 
@@ -224,19 +213,24 @@ def main():
     print("=" * 60)
     
     # Step 1: Fetch OSM data
-    osm_data = fetch_osm_buildings()
-    if not osm_data:
+    osm_elements = fetch_osm_buildings()
+    if osm_elements is None:
         print("Failed to fetch OSM data")
         return
     
-    # Step 2: Convert to GeoJSON
-    geojson_data = convert_osm_to_geojson(osm_data)
-    if not geojson_data:
-        print("Failed to convert OSM data to GeoJSON")
+    # Step 2: Convert to GeoDataFrame (elements are still being downloaded here,
+    # so a dropped connection or truncated response surfaces in this step)
+    try:
+        buildings_gdf = convert_osm_to_geodataframe(osm_elements)
+    except Exception as e:
+        print(f"Error reading OSM data stream: {e}")
+        return
+    if buildings_gdf is None or buildings_gdf.empty:
+        print("Failed to convert OSM data to building polygons")
         return
     
-    # Step 3: Classify with DuckDB
-    classified_gdf = classify_buildings_with_duckdb(geojson_data)
+    # Step 3: Classify by OSM tags
+    classified_gdf = classify_buildings(buildings_gdf)
     
     # Step 4: Save to GeoJSON
     output_path = 'frontend/public/output/venice_buildings_classified.geojson'